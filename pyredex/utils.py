@@ -5,22 +5,33 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
-import distutils.version
+import collections
+import concurrent.futures
 import errno
-import fnmatch
+import functools
 import glob
+import io
+import lzma
 import os
 import re
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
 import zipfile
+import zlib
 from os.path import basename, isfile, join
 
 import pyredex.unpacker
 from pyredex.logger import log
 
+try:
+    # Optional; the zstd command line tool is used when it is not installed.
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 temp_dirs = []
 
@@ -59,22 +70,32 @@ def with_temp_cleanup(fn, always_clean=False):
             remove_temp_dirs()
 
 
+_VERSION_RE = re.compile(r"\d+\.\d+\.\d+$")
+
+
+@functools.lru_cache(maxsize=1)
 def find_android_build_tools():
-    VERSION_REGEXP = r"\d+\.\d+\.\d+$"
     android_home = os.environ["ANDROID_SDK"]
     build_tools = join(android_home, "build-tools")
     version = max(
-        (d for d in os.listdir(build_tools) if re.match(VERSION_REGEXP, d)),
-        key=distutils.version.StrictVersion,
+        (d for d in os.listdir(build_tools) if _VERSION_RE.match(d)),
+        key=lambda d: tuple(map(int, d.split("."))),
     )
     return join(build_tools, version)
 
 
 def remove_signature_files(extracted_apk_dir):
-    for f in abs_glob(extracted_apk_dir, "META-INF/*"):
-        cert_path = join(extracted_apk_dir, f)
-        if isfile(cert_path):
-            os.remove(cert_path)
+    try:
+        entries = os.scandir(join(extracted_apk_dir, "META-INF"))
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            # Hidden files are left in place.
+            if not entry.name.startswith(".") and entry.is_file(
+                follow_symlinks=False
+            ):
+                os.remove(entry.path)
 
 
 def sign_apk(keystore, keypass, keyalias, apk):
@@ -96,23 +117,31 @@ def sign_apk(keystore, keypass, keyalias, apk):
     )
 
 
+# Matches the part of a line that precedes a comment. A backslash escapes the
+# following character, except that it never hides a '#' outside of a string.
+# Unterminated strings run to the end of the line.
+_NON_COMMENT_RE = re.compile(
+    r'(?:[^"\\#]|\\[^#]?|"(?:[^"\\]|\\.?)*(?:"|\Z))*', re.DOTALL
+)
+
+
 def remove_comments_from_line(l):
-    (found_backslash, in_quote) = (False, False)
-    for idx, c in enumerate(l):
-        if c == "\\" and not found_backslash:
-            found_backslash = True
-        elif c == '"' and not found_backslash:
-            found_backslash = False
-            in_quote = not in_quote
-        elif c == "#" and not in_quote:
-            return l[:idx]
-        else:
-            found_backslash = False
-    return l
+    if '"' not in l:
+        # Without strings, the first '#' always starts the comment.
+        idx = l.find("#")
+        return l if idx < 0 else l[:idx]
+    end = _NON_COMMENT_RE.match(l).end()
+    return l[:end] if end < len(l) else l
 
 
 def remove_comments(lines):
-    return "".join([remove_comments_from_line(l) + "\n" for l in lines])
+    buf = io.StringIO()
+    write = buf.write
+    strip = remove_comments_from_line
+    for l in lines:
+        write(strip(l))
+        write("\n")
+    return buf.getvalue()
 
 
 def argparse_yes_no_flag(parser, flag_name, on_prefix="", off_prefix="no-", **kwargs):
@@ -142,24 +171,35 @@ def unzip_apk(apk, destination_directory):
         z.extractall(destination_directory)
 
 
+_DEX_NUMBER_RE = re.compile(r"(?:classes|.*-)(\d+)")
+
+
 def extract_dex_number(dexfilename):
-    m = re.search(r"(classes|.*-)(\d+)", basename(dexfilename))
+    m = _DEX_NUMBER_RE.search(basename(dexfilename))
     if m is None:
         raise Exception("Bad secondary dex name: " + dexfilename)
-    return int(m.group(2))
+    return int(m.group(1))
 
 
 def dex_glob(directory):
     """
     Return the dexes in a given directory, with the primary dex first.
     """
-    primary = join(directory, "classes.dex")
-    if not isfile(primary):
+    primary = None
+    secondaries = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith(".") or not name.endswith(".dex"):
+                continue
+            if name == "classes.dex":
+                if entry.is_file():
+                    primary = entry.path
+            elif not name.endswith("classes.dex"):
+                secondaries.append(entry.path)
+    if primary is None:
         raise Exception("No primary dex found")
 
-    secondaries = [
-        d for d in glob.glob(join(directory, "*.dex")) if not d.endswith("classes.dex")
-    ]
     secondaries.sort(key=extract_dex_number)
 
     return [primary] + secondaries
@@ -175,49 +215,249 @@ def move_dexen_to_directories(root, dexpaths):
     for idx, dexpath in enumerate(dexpaths):
         dexname = basename(dexpath)
         dirpath = join(root, "dex" + str(idx))
+        newpath = join(dirpath, dexname)
         os.mkdir(dirpath)
-        shutil.move(dexpath, dirpath)
-        res.append(join(dirpath, dexname))
+        try:
+            os.rename(dexpath, newpath)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise e
+            shutil.move(dexpath, newpath)
+        res.append(newpath)
 
     return res
 
 
 def ensure_libs_dir(libs_dir, sub_dir):
-    """Ensures the base libs directory and the sub directory exist. Returns top
-    most dir that was created.
+    """Ensures the base libs directory and the sub directory exist. Returns the
+    directory the caller owns and should remove when done: libs_dir if it did
+    not exist before, otherwise sub_dir (even if sub_dir already existed).
     """
-    if os.path.exists(libs_dir):
-        os.mkdir(sub_dir)
-        return sub_dir
-    else:
-        os.mkdir(libs_dir)
-        os.mkdir(sub_dir)
-        return libs_dir
+    existed = os.path.isdir(libs_dir)
+    os.makedirs(sub_dir, exist_ok=True)
+    return sub_dir if existed else libs_dir
 
 
 def get_file_ext(file_name):
     return os.path.splitext(file_name)[1]
 
 
+def _compress_file(entry):
+    """
+    Reads and compresses a single file for ZipManager. Runs in a worker
+    process, so it only returns plain data: the payload as it should be
+    stored in the archive, along with the metadata needed for its header.
+    If the file still has the CRC and size given in `original`, the payload is
+    None and the caller is expected to reuse the compressed data of the input.
+    """
+    filepath, archivepath, compress_type, compress_level, original = entry
+    if original is not None and os.path.getsize(filepath) == original[1]:
+        crc = 0
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                crc = zlib.crc32(chunk, crc)
+        if crc == original[0]:
+            return (archivepath, None, crc, original[1], compress_type)
+
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    else:
+        compress_type = zipfile.ZIP_STORED
+        compressor = None
+    crc = 0
+    size = 0
+    parts = []
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            parts.append(compressor.compress(chunk) if compressor else chunk)
+    if compressor:
+        parts.append(compressor.flush())
+    return (archivepath, b"".join(parts), crc, size, compress_type)
+
+
+def _ordered_map(executor, fn, iterable, window):
+    """
+    Like executor.map, but submits at most `window` tasks ahead of the
+    result being consumed instead of queueing the whole iterable up front.
+    """
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def _extract_target(root, filename):
+    """
+    Returns the path that ZipFile.extract writes `filename` to under `root`.
+    """
+    arcname = filename.replace("/", os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    arcname = os.path.sep.join(
+        x
+        for x in arcname.split(os.path.sep)
+        if x not in ("", os.path.curdir, os.path.pardir)
+    )
+    if os.path.sep == "\\":
+        arcname = zipfile.ZipFile._sanitize_windows_name(arcname, os.path.sep)
+    return os.path.normpath(join(root, arcname))
+
+
+def _extract_members(zip_path, infos, directory):
+    with zipfile.ZipFile(zip_path) as z:
+        for info in infos:
+            z.extract(info, directory)
+
+
+def _start_entry(zf, zinfo):
+    zip64 = (
+        zinfo.file_size > zipfile.ZIP64_LIMIT
+        or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    )
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader(zip64))
+
+
+def _finish_entry(zf, zinfo):
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf.start_dir = zf.fp.tell()
+    zf._didModify = True
+
+
+def _write_compressed_entry(zf, zinfo, payload):
+    """
+    Appends an entry whose payload has already been compressed. `zinfo` must
+    have CRC, file_size, compress_size and compress_type filled in.
+    """
+    _start_entry(zf, zinfo)
+    zf.fp.write(payload)
+    _finish_entry(zf, zinfo)
+
+
+def _copy_raw_entry(zf, zinfo, src, src_info):
+    """
+    Appends the compressed data of `src_info` from the raw zip stream `src`
+    without inflating it. Only the headers are rewritten.
+    """
+    src.seek(src_info.header_offset)
+    header = src.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader:
+        raise zipfile.BadZipFile("Truncated file header: " + src_info.filename)
+    header = struct.unpack(zipfile.structFileHeader, header)
+    if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad magic number for file header")
+    fname = src.read(header[zipfile._FH_FILENAME_LENGTH])
+    if header[zipfile._FH_GENERAL_PURPOSE_FLAG_BITS] & 0x800:
+        fname_str = fname.decode("utf-8", "replace")
+    else:
+        fname_str = fname.decode("cp437")
+    if fname_str != src_info.orig_filename:
+        raise zipfile.BadZipFile(
+            "File name in directory %r and header %r differ."
+            % (src_info.orig_filename, fname)
+        )
+    src.seek(header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+    _start_entry(zf, zinfo)
+    remaining = src_info.compress_size
+    while remaining > 0:
+        chunk = src.read(min(remaining, 1 << 20))
+        if not chunk:
+            raise zipfile.BadZipFile("Truncated entry: " + src_info.filename)
+        zf.fp.write(chunk)
+        remaining -= len(chunk)
+    _finish_entry(zf, zinfo)
+
+
 class ZipManager:
     """
     __enter__: Unzips input_apk into extracted_apk_dir
     __exit__: Zips extracted_apk_dir into output_apk
-    """
 
-    per_file_compression = {}
+    Files that are unchanged since extraction are copied over from input_apk
+    as-is, without being compressed again.
 
-    def __init__(self, input_apk, extracted_apk_dir, output_apk):
+    compress_level only applies to deflated entries. It defaults to 1, which is
+    much faster than zlib's default of 6 for a slightly larger apk; release
+    builds may want to pass 6 or 9.
+    """
+
+    def __init__(self, input_apk, extracted_apk_dir, output_apk, compress_level=1):
         self.input_apk = input_apk
         self.extracted_apk_dir = extracted_apk_dir
         self.output_apk = output_apk
+        self.compress_level = compress_level
+        self.per_file_compression = {}
+        self.reusable_entries = {}
 
     def __enter__(self):
         log("Extracting apk...")
+        root = os.path.normpath(self.extracted_apk_dir)
+        targets = {}
         with zipfile.ZipFile(self.input_apk) as z:
             for info in z.infolist():
                 self.per_file_compression[info.filename] = info.compress_type
-            z.extractall(self.extracted_apk_dir)
+                if not info.flag_bits & 0x1 and info.compress_type in (
+                    zipfile.ZIP_STORED,
+                    zipfile.ZIP_DEFLATED,
+                ):
+                    self.reusable_entries[info.filename] = info
+                path = _extract_target(root, info.filename)
+                # Fold case so that names which collide on case-insensitive
+                # filesystems are grouped as well.
+                targets.setdefault(path.casefold(), []).append((path, info))
+
+            # zipfile creates missing parent directories on its own, which
+            # races when several threads extract into the same tree, so create
+            # them up front. Entries that share a target path (duplicate names,
+            # names that only differ before sanitizing or only in case) are
+            # extracted here in archive order, so the last one wins as with
+            # extractall.
+            infos = []
+            for members in targets.values():
+                if len(members) > 1 or members[0][0] == root:
+                    for _, info in members:
+                        z.extract(info, self.extracted_apk_dir)
+                    continue
+                path, info = members[0]
+                os.makedirs(
+                    path if info.is_dir() else os.path.dirname(path), exist_ok=True
+                )
+                infos.append(info)
+
+        # Inflating is CPU bound but zlib releases the GIL, so threads scale.
+        shards = min(8, os.cpu_count() or 1)
+        with concurrent.futures.ThreadPoolExecutor(shards) as executor:
+            list(
+                executor.map(
+                    _extract_members,
+                    [self.input_apk] * shards,
+                    [infos[i::shards] for i in range(shards)],
+                    [self.extracted_apk_dir] * shards,
+                )
+            )
+
+    def _entries(self):
+        # Need sorted output for deterministic zip file. Sorting `dirnames` will
+        # ensure the tree walk order. Sorting `filenames` will ensure the files
+        # inside the tree.
+        for dirpath, dirnames, filenames in os.walk(self.extracted_apk_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                filepath = join(dirpath, filename)
+                archivepath = filepath[len(self.extracted_apk_dir) + 1 :]
+                compress = self.per_file_compression.get(
+                    archivepath, zipfile.ZIP_DEFLATED
+                )
+                info = self.reusable_entries.get(archivepath)
+                original = (info.CRC, info.file_size) if info is not None else None
+                yield (filepath, archivepath, compress, self.compress_level, original)
 
     def __exit__(self, *args):
         remove_signature_files(self.extracted_apk_dir)
@@ -225,21 +465,32 @@ class ZipManager:
             os.remove(self.output_apk)
 
         log("Creating output apk")
-        with zipfile.ZipFile(self.output_apk, "w") as new_apk:
-            # Need sorted output for deterministic zip file. Sorting `dirnames` will
-            # ensure the tree walk order. Sorting `filenames` will ensure the files
-            # inside the tree.
-            # This scheme uses less memory than collecting all files first.
-            for dirpath, dirnames, filenames in os.walk(self.extracted_apk_dir):
-                dirnames.sort()
-                for filename in sorted(filenames):
-                    filepath = join(dirpath, filename)
-                    archivepath = filepath[len(self.extracted_apk_dir) + 1 :]
-                    try:
-                        compress = self.per_file_compression[archivepath]
-                    except KeyError:
-                        compress = zipfile.ZIP_DEFLATED
-                    new_apk.write(filepath, archivepath, compress_type=compress)
+        # Compression is CPU bound, so spread it across processes. Results are
+        # consumed in submission order, which keeps the output deterministic,
+        # and only a few tasks per worker are in flight so that the compressed
+        # payloads waiting to be written stay bounded.
+        workers = os.cpu_count() or 1
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor, open(
+            self.input_apk, "rb"
+        ) as src, zipfile.ZipFile(self.output_apk, "w") as new_apk:
+            for archivepath, payload, crc, size, compress in _ordered_map(
+                executor, _compress_file, self._entries(), 2 * workers
+            ):
+                # Use a fixed timestamp and mode so that repacking the same
+                # contents always produces the same apk.
+                zinfo = zipfile.ZipInfo(archivepath, (1980, 1, 1, 0, 0, 0))
+                zinfo.external_attr = 0o644 << 16
+                zinfo.CRC = crc
+                zinfo.file_size = size
+                if payload is None:
+                    src_info = self.reusable_entries[archivepath]
+                    zinfo.compress_type = src_info.compress_type
+                    zinfo.compress_size = src_info.compress_size
+                    _copy_raw_entry(new_apk, zinfo, src, src_info)
+                else:
+                    zinfo.compress_type = compress
+                    zinfo.compress_size = len(payload)
+                    _write_compressed_entry(new_apk, zinfo, payload)
 
 
 class UnpackManager:
@@ -282,20 +533,22 @@ class UnpackManager:
             self.extracted_apk_dir
         )
         store_files = []
+        extracted_apk_dir = self.extracted_apk_dir
+        dex_dir = self.dex_dir
+        mkdir = os.mkdir
         for module in self.application_modules:
+            name = module.get_name()
             canary_prefix = module.get_canary_prefix()
             log(
                 "found module: "
-                + module.get_name()
+                + name
                 + " "
                 + (canary_prefix if canary_prefix is not None else "(no canary prefix)")
             )
-            store_path = os.path.join(self.dex_dir, module.get_name())
-            os.mkdir(store_path)
-            module.unpackage(self.extracted_apk_dir, store_path)
-            store_metadata = os.path.join(
-                store_metadata_dir, module.get_name() + ".json"
-            )
+            store_path = join(dex_dir, name)
+            mkdir(store_path)
+            module.unpackage(extracted_apk_dir, store_path)
+            store_metadata = join(store_metadata_dir, name + ".json")
             module.write_redex_metadata(store_path, store_metadata)
             store_files.append(store_metadata)
         return store_files
@@ -341,6 +594,33 @@ class UnpackManager:
             return extracted_apk_dir
 
 
+def _find_compressed_libs(directory):
+    pending = [directory]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.name == "libs.xzs":
+                    yield entry.path
+                # For voltron modules BUCK creates empty zstd files for each module
+                elif entry.name == "libs.zstd" and entry.stat().st_size > 0:
+                    yield entry.path
+
+
+def _decompress_lib(lib_path, extract_path):
+    if lib_path.endswith(".xzs"):
+        with lzma.open(lib_path) as src, open(extract_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    elif zstandard is not None:
+        with open(lib_path, "rb") as src, open(extract_path, "wb") as dst:
+            zstandard.ZstdDecompressor().copy_stream(
+                src, dst, read_size=1 << 20, write_size=1 << 20
+            )
+    else:
+        subprocess.check_call(["zstd", "-d", lib_path, "-o", extract_path])
+
+
 class LibraryManager:
     """
     __enter__: Unpacks additional libraries in extracted_apk_dirs so library class files can be found
@@ -356,31 +636,20 @@ class LibraryManager:
         # Some of the native libraries can be concatenated together into one
         # xz-compressed file. We need to decompress that file so that we can scan
         # through it looking for classnames.
-        libs_to_extract = []
-        xz_lib_name = "libs.xzs"
-        zstd_lib_name = "libs.zstd"
-        for root, _, filenames in os.walk(self.extracted_apk_dir):
-            for filename in fnmatch.filter(filenames, xz_lib_name):
-                libs_to_extract.append(join(root, filename))
-            for filename in fnmatch.filter(filenames, zstd_lib_name):
-                fullpath = join(root, filename)
-                # For voltron modules BUCK creates empty zstd files for each module
-                if os.path.getsize(fullpath) > 0:
-                    libs_to_extract.append(fullpath)
+        libs_to_extract = list(_find_compressed_libs(self.extracted_apk_dir))
         if len(libs_to_extract) > 0:
             libs_dir = join(self.extracted_apk_dir, "lib")
             extracted_dir = join(libs_dir, "__extracted_libs__")
             # Ensure both directories exist.
             self.temporary_libs_dir = ensure_libs_dir(libs_dir, extracted_dir)
-            lib_count = 0
-            for lib_to_extract in libs_to_extract:
-                extract_path = join(extracted_dir, "lib_{}.so".format(lib_count))
-                if lib_to_extract.endswith(xz_lib_name):
-                    cmd = "xz -d --stdout {} > {}".format(lib_to_extract, extract_path)
-                else:
-                    cmd = "zstd -d {} -o {}".format(lib_to_extract, extract_path)
-                subprocess.check_call(cmd, shell=True)
-                lib_count += 1
+            extract_paths = [
+                join(extracted_dir, "lib_{}.so".format(lib_count))
+                for lib_count in range(len(libs_to_extract))
+            ]
+            # The decoders release the GIL, so threads are enough to decompress
+            # the libraries in parallel.
+            with concurrent.futures.ThreadPoolExecutor(os.cpu_count()) as executor:
+                list(executor.map(_decompress_lib, libs_to_extract, extract_paths))
 
     def __exit__(self, *args):
         # This dir was just here so we could scan it for classnames, but we don't
@@ -725,6 +725,15 @@ Given an APK, produce a better APK!
         action="store_true",
         help="Preserve 4k page alignment for uncompressed libs",
     )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        choices=range(10),
+        default=1,
+        metavar="{0..9}",
+        help="zlib level used for compressed entries of the output APK "
+        "(defaults to 1 for speed; use 6 or 9 for release builds)",
+    )
 
     parser.add_argument(
         "--side-effect-summaries", help="Side effect information for external methods"
@@ -864,7 +873,12 @@ def prepare_redex(args):
 
     directory = make_temp_dir(".redex_unaligned", False)
     unaligned_apk_path = join(directory, "redex-unaligned.apk")
-    zip_manager = ZipManager(args.input_apk, extracted_apk_dir, unaligned_apk_path)
+    zip_manager = ZipManager(
+        args.input_apk,
+        extracted_apk_dir,
+        unaligned_apk_path,
+        compress_level=args.compression_level,
+    )
     zip_manager.__enter__()
 
     if not dex_dir: